@@ -31,17 +31,19 @@ import os
 import copy
 import re
 import sys
-import glob
-import traceback
 import struct
+import codecs
+import errno
 import datetime
-from email.parser import Parser as EmailParser
-import email.utils
 import olefile as OleFile
-import json
-from imapclient.imapclient import decode_utf7
-import random
-import string
+import time
+import threading
+import io
+import contextlib
+
+# Modules that are only needed by some code paths (email, json, glob,
+# traceback, sqlite3, multiprocessing, zipfile...) are imported where they
+# are used, to keep startup fast for short lived processes and new workers.
 
 
 # This property information was sourced from
@@ -188,6 +190,13 @@ if sys.version_info[0] >= 3:  # Python 3
         return a
     def encode(inp):
         return inp
+
+    def toUnicode(inp):
+        if inp is None:
+            return None
+        if type(inp) == bytes:
+            return inp.decode('utf8', 'replace')
+        return str(inp)
 else:  # Python 2
     def windowsUnicode(string):
         if string is None:
@@ -210,12 +219,102 @@ else:  # Python 2
     def encode(inp):
         return inp.encode('utf8')
 
+    def toUnicode(inp):
+        if inp is None:
+            return None
+        if type(inp) == str:
+            return inp.decode('utf8', 'replace')
+        return unicode(inp)
+
 def msgEpoch(inp):
     ep = 116444736000000000
     return (inp - ep)/10000000.0
 
 def xstr(s):
-    return '' if s is None else str(s)
+    return u'' if s is None else toUnicode(s)
+
+# Windows code page numbers whose Python codec is not simply 'cp<number>'
+_codepageNames = {
+    1200: 'utf_16_le',
+    1201: 'utf_16_be',
+    10000: 'mac_roman',
+    20127: 'ascii',
+    20866: 'koi8_r',
+    21866: 'koi8_u',
+    28591: 'latin_1',
+    28592: 'iso8859_2',
+    28593: 'iso8859_3',
+    28594: 'iso8859_4',
+    28595: 'iso8859_5',
+    28596: 'iso8859_6',
+    28597: 'iso8859_7',
+    28598: 'iso8859_8',
+    28599: 'iso8859_9',
+    28603: 'iso8859_13',
+    28605: 'iso8859_15',
+    50220: 'iso2022_jp',
+    50221: 'iso2022_jp',
+    50222: 'iso2022_jp',
+    51932: 'euc_jp',
+    51949: 'euc_kr',
+    52936: 'hz',
+    54936: 'gb18030',
+    65000: 'utf_7',
+    65001: 'utf_8',
+}
+
+DEFAULT_CODEPAGE = 1252
+
+_decoders = {}
+
+def getDecoder(codepage):
+    """
+    Returns a function decoding bytes in the Windows `codepage` to text,
+    replacing anything that cannot be decoded. Unknown code pages fall
+    back to `DEFAULT_CODEPAGE`. Decoders are cached per code page, so
+    looking one up for every string property costs a dictionary lookup.
+    """
+    try:
+        return _decoders[codepage]
+    except KeyError:
+        pass
+    try:
+        decoder = codecs.getdecoder(_codepageNames.get(codepage, 'cp' + str(codepage)))
+    except LookupError:
+        decoder = codecs.getdecoder('cp' + str(DEFAULT_CODEPAGE))
+
+    def decode(data):
+        return decoder(data, 'replace')[0]
+
+    _decoders[codepage] = decode
+    return decode
+
+_utf7Shifted = re.compile(b'&([^-]*)(-|$)')
+
+def decode_utf7(s):
+    """
+    Decodes IMAP modified UTF-7 (RFC 3501) to unicode. Bytes outside of
+    the shifted '&...-' sections are taken as-is, one character per byte.
+    Anything that is not bytes is returned unchanged. This matches the
+    decoder in imapclient, which used to be imported just for this, and
+    stays public for code that imported it from here.
+    """
+    if not isinstance(s, bytes):
+        return s
+    out = []
+    pos = 0
+    for match in _utf7Shifted.finditer(s):
+        out.append(s[pos:match.start()].decode('latin-1'))
+        shifted = match.group(1)
+        if not shifted:
+            # '&-' is a literal '&'; a lone '&' at the end decodes to nothing
+            if match.group(2):
+                out.append(u'&')
+        else:
+            out.append((b'+' + shifted.replace(b',', b'/') + b'-').decode('utf-7'))
+        pos = match.end()
+    out.append(s[pos:].decode('latin-1'))
+    return u''.join(out)
 
 def addNumToDir(dirName):
     # Attempt to create the directory with a '(n)' appended
@@ -228,8 +327,126 @@ def addNumToDir(dirName):
             pass
     return None
 
+def ensureDir(dirName):
+    """
+    Creates `dirName` and its parents if they do not exist yet. Safe to
+    call from several threads or processes at once.
+    """
+    if dirName and not os.path.isdir(dirName):
+        try:
+            os.makedirs(dirName)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+def makeUniqueDir(dirName):
+    """
+    Creates `dirName`, or `dirName` with ' (n)' appended if it already
+    exists, and returns the name that was created. Creating the directory
+    is what claims the name, so concurrent callers never get the same one.
+    """
+    ensureDir(os.path.dirname(dirName))
+    newDirName = dirName
+    i = 1
+    while True:
+        try:
+            os.mkdir(newDirName)
+            return newDirName
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        i += 1
+        newDirName = dirName + ' (' + str(i) + ')'
+
+def openUniqueFile(filename):
+    """
+    Opens a new file for binary writing at `filename`, or with ' (n)'
+    inserted before the extension if that name is taken. The file is
+    created exclusively, so concurrent callers never write to the same
+    file. Returns the open file and the name that was used.
+    """
+    root, ext = os.path.splitext(filename)
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0)
+    newFilename = filename
+    i = 1
+    while True:
+        try:
+            return os.fdopen(os.open(newFilename, flags, 0o666), 'wb'), newFilename
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        i += 1
+        newFilename = root + ' (' + str(i) + ')' + ext
+
 fromTimeStamp = datetime.datetime.fromtimestamp
 
+#: Streams bigger than this are spooled to a temporary file by
+#: Message.openStream instead of being held in memory
+DEFAULT_SPILL_THRESHOLD = 8 * 1024 * 1024
+
+#: Size of the chunks iterStream reads large streams in
+CHUNK_SIZE = 1024 * 1024
+
+class MemoryBudgetError(Exception):
+    """
+    Raised when reading a stream into memory would take a message over
+    its memory budget.
+    """
+    pass
+
+def iterStream(ole, filename, chunkSize = CHUNK_SIZE):
+    """
+    Yields the contents of a stream of the open OleFileIO `ole` in chunks
+    of about `chunkSize` bytes. olefile's openstream reads the whole
+    stream into memory, so big streams are instead read here sector by
+    sector, following the FAT, and never held at once. Small streams
+    live in the mini stream and are simply read whole.
+    """
+    entry = ole.direntries[ole._find(filename)]
+    if entry.size < ole.minisectorcutoff:
+        yield ole.openstream(filename).read()
+        return
+    remaining = entry.size
+    sect = entry.isectStart
+    sectors = 0
+    chunk = []
+    chunkLength = 0
+    while remaining > 0:
+        if sect > OleFile.MAXREGSECT or sect >= len(ole.fat) or sectors > entry.size // ole.sectorsize + 1:
+            raise IOError('Broken sector chain in stream ' + str(filename))
+        ole.fp.seek(ole.sectorsize * (sect + 1))
+        data = ole.fp.read(min(ole.sectorsize, remaining))
+        if not data:
+            raise IOError('Stream ' + str(filename) + ' is truncated')
+        remaining -= len(data)
+        chunk.append(data)
+        chunkLength += len(data)
+        if chunkLength >= chunkSize:
+            yield b''.join(chunk)
+            chunk = []
+            chunkLength = 0
+        sect = ole.fat[sect]
+        sectors += 1
+    if chunk:
+        yield b''.join(chunk)
+
+class _BudgetedBytesIO(io.BytesIO):
+    # Gives its bytes back to the message's memory budget once closed
+    def __init__(self, msg, data):
+        io.BytesIO.__init__(self, data)
+        self.__msg = msg
+        self.__size = len(data)
+
+    def close(self):
+        if self.__msg is not None:
+            self.__msg._release(self.__size)
+            self.__msg = None
+        io.BytesIO.close(self)
+
+    def __del__(self):
+        # Python 2 does not call an overridden close when collecting
+        self.close()
+
 class Attachment:
     def __init__(self, msg, dir_):
         self.msg = msg
@@ -243,28 +460,136 @@ class Attachment:
         # Get Content-ID
         self.cid = msg._getStringStream([dir_, '__substg1.0_3712'])
 
-        # Get attachment data
+        # Attachment data is only read when it is asked for
         if msg.Exists([dir_, '__substg1.0_37010102']):
             self.__type = 'data'
-            self.data = msg._getStream([dir_, '__substg1.0_37010102'])
+            self.__stream = [dir_, '__substg1.0_37010102']
         elif msg.Exists([dir_, '__substg1.0_3701000D']):
-            if (self.props['37050003'].value & 0x7) != 0x5:
-                raise NotImplementedError('Current version of ExtractMsg.py does not support extraction of containers that are not embeded msg files.')
-                #TODO add implementation
             self.__prefix = msg.prefixList + [dir_, '__substg1.0_3701000D']
-            self.__type = 'msg'
+            if (self.props['37050003'].value & 0x7) != 0x5:
+                # Other containers (OLE objects) are saved stream by stream
+                self.__type = 'container'
+            else:
+                self.__type = 'msg'
         else:
             raise Exception('Unknown file type')
 
-    def saveEmbededMessage(self, contentId = False, json = False, useFileName = False, raw = False):
+    @property
+    def type(self):
+        return self.__type
+
+    @property
+    def data(self):
+        """
+        The attachment data, read into memory (and counted against the
+        message's memory budget) on first use. None unless the type is
+        'data'. Use `openData` or `save` for big attachments instead.
+        """
+        if self.__type != 'data':
+            return None
+        try:
+            return self.__data
+        except AttributeError:
+            self.__data = self.msg._getStream(self.__stream)
+            return self.__data
+
+    @property
+    def size(self):
+        """
+        Size of the attachment data in bytes, without reading it.
+        """
+        if self.__type != 'data':
+            return None
+        return self.msg.getStreamSize(self.__stream)
+
+    def head(self, size):
+        """
+        Returns the first `size` bytes of the attachment data.
+        """
+        if self.__type != 'data':
+            return None
+        try:
+            return self.__data[:size]
+        except AttributeError:
+            return next(self.msg.iterStream(self.__stream, size), b'')[:size]
+
+    def openData(self):
+        """
+        Returns a file object holding the attachment data. Big attachments
+        are spooled to a temporary file rather than held in memory.
+        """
+        if self.__type != 'data':
+            return None
+        return self.msg.openStream(self.__stream)
+
+    def release(self):
+        """
+        Drops the cached attachment data and gives its bytes back to the
+        message's memory budget.
+        """
+        try:
+            data = self.__data
+        except AttributeError:
+            return
+        del self.__data
+        if data is not None:
+            self.msg._release(len(data))
+
+    @property
+    def prefixList(self):
+        """
+        The storage holding an embedded msg or container attachment.
+        """
+        return self.__prefix
+
+    def openEmbeddedMessage(self):
+        """
+        Opens the embedded message. It reads through the file handle of
+        the message it is attached to and is closed along with it, but
+        can be closed (or used in a with statement) earlier.
+        """
+        return Message(self.msg.path, self.__prefix, parent = self.msg)
+
+    def saveEmbededMessage(self, contentId = False, json = False, useFileName = False, raw = False, outputDir = None):
         """
         Seperate function from save to allow it to
-        easily be overridden by a subclass
+        easily be overridden by a subclass. Returns the
+        paths the embedded message saved.
         """
-        msg = Message(self.msg.path, self.__prefix)
-        msg.save(json, useFileName, raw, contentId)
+        with self.openEmbeddedMessage() as msg:
+            return msg.save(json, useFileName, raw, contentId, outputDir)
 
-    def save(self, contentId = False, json = False, useFileName = False, raw = False):
+    def saveContainer(self, filename, outputDir = None):
+        """
+        Writes every stream of a container attachment into a new directory
+        named `filename`, keeping the storage layout, and returns the
+        directory. Seperate function from save to allow it to easily be
+        overridden by a subclass
+        """
+        dirName = makeUniqueDir(os.path.join(outputDir or '', filename))
+        prefix = self.__prefix
+        for entry in self.msg.listdir():
+            if entry[:len(prefix)] != prefix or len(entry) <= len(prefix):
+                continue
+            sysdir = os.path.join(dirName, *entry[len(prefix):-1])
+            ensureDir(sysdir)
+            f = open(os.path.join(sysdir, entry[-1]), 'wb')
+            try:
+                for chunk in iterStream(self.msg, entry):
+                    f.write(chunk)
+            finally:
+                f.close()
+        return dirName
+
+    def save(self, contentId = False, json = False, useFileName = False, raw = False, outputDir = None):
+        """
+        Saves the attachment into `outputDir`, or the current directory if
+        it is not given, and returns the path written. An existing file is
+        never overwritten; ' (n)' is added to the name instead. Container
+        attachments that are not messages are written as a directory of
+        their streams. Embedded messages save their own attachments, and
+        the list of paths they wrote is returned instead.
+        """
         # Use long filename as first preference
         filename = self.longFilename
         # Check if user wants to save the file under the Content-id
@@ -275,16 +600,30 @@ class Attachment:
             filename = self.shortFilename
         # Otherwise just make something up!
         if filename is None:
+            import random
+            from string import ascii_uppercase, digits
             filename = 'UnknownFilename ' + \
-                ''.join(random.choice(string.ascii_uppercase + string.digits)
+                ''.join(random.choice(ascii_uppercase + digits)
                         for _ in range(5)) + '.bin'
 
+        # Never let an attachment name point outside of the output directory
+        filename = filename.replace('/', '_').replace('\\', '_')
+
         if self.__type == "data":
-            f = open(filename, 'wb')
-            f.write(self.data)
-            f.close()
+            ensureDir(outputDir)
+            f, filename = openUniqueFile(os.path.join(outputDir or '', filename))
+            try:
+                try:
+                    f.write(self.__data)
+                except AttributeError:
+                    for chunk in self.msg.iterStream(self.__stream):
+                        f.write(chunk)
+            finally:
+                f.close()
+        elif self.__type == "msg":
+            return self.saveEmbededMessage(contentId, json, useFileName, raw, outputDir)
         else:
-            self.saveEmbededMessage(contentId, json, useFileName, raw)
+            filename = self.saveContainer(filename, outputDir)
         return filename
 
     @property
@@ -292,7 +631,7 @@ class Attachment:
         try:
             return self.__props
         except:
-            self.__props = Properties(self.msg._getStream(self.msg.prefixList + [self.__dir, '__properties_version1.0']))
+            self.__props = Properties(self.msg._getStream([self.__dir, '__properties_version1.0']))
             return self.__props
 
 class Properties:
@@ -398,7 +737,7 @@ class Recipient:
         self.__email = msg._getStringStream(self.__dir + '/__substg1.0_39FE')
         self.__name = msg._getStringStream(self.__dir + '/__substg1.0_3001')
         self.__type = self.__props.get('0C150003').value
-        self.__formatted = '{0} <{1}>'.format(self.__name, self.__email)
+        self.__formatted = u'{0} <{1}>'.format(self.__name, self.__email)
 
     @property
     def type(self):
@@ -421,7 +760,8 @@ class Recipient:
         return self.__props
 
 class Message(OleFile.OleFileIO):
-    def __init__(self, filename, prefix = '', attachmentClass = Attachment):
+    def __init__(self, filename, prefix = '', attachmentClass = Attachment, parent = None,
+                 memoryBudget = None, spillThreshold = DEFAULT_SPILL_THRESHOLD):
         """
         `prefix` is used for extracting embeded msg files
             inside the main one. Do not set manually unless
@@ -432,12 +772,48 @@ class Message(OleFile.OleFileIO):
             not change this value unless you know what you
             are doing.
 
+        `parent` is the message an embedded message was
+            opened from. The embedded message then shares
+            its parent's file handle instead of opening the
+            file again, and is closed along with it. Set by
+            Attachment.openEmbeddedMessage.
+
+        `memoryBudget` is the most bytes of stream data the
+            message may hold in memory at once, or None for no
+            limit. Reading past it raises MemoryBudgetError.
+            Embedded messages count against their parent.
+
+        `spillThreshold` is the size above which openStream
+            spools a stream to a temporary file instead of
+            reading it into memory.
+
+        Messages hold an open file until `close` is called,
+        so prefer using them in a with statement.
         """
         #print(prefix)
         #WARNING DO NOT MANUALLY MODIFY PREFIX. Let the program set it.
+        self.__parent = parent
+        self.__children = []
+        self.__closed = False
+        self.__memoryBudget = memoryBudget
+        self.__spillThreshold = spillThreshold
+        self.__memoryUsage = 0
+        self.__peakMemory = 0
+        if parent is not None:
+            self.__spillThreshold = parent.spillThreshold
+            filename = parent.path
         self.__path = filename
         self.__attachmentClass = attachmentClass
-        OleFile.OleFileIO.__init__(self, filename)
+        OleFile.OleFileIO.__init__(self, filename if parent is None else parent.fp)
+        if parent is not None:
+            parent.__children.append(self)
+        try:
+            self.__load(filename, prefix)
+        except Exception:
+            self.close()
+            raise
+
+    def __load(self, filename, prefix):
         prefixl = []
         if prefix != '':
             if type(prefix) not in stri:
@@ -452,9 +828,11 @@ class Message(OleFile.OleFileIO):
             prefixl = g
             if prefix[-1] != '/':
                 prefix += '/'
-            filename = self._getStringStream(prefixl[:-1] + ['__substg1.0_3001'], prefix = False)
         self.__prefix = prefix
         self.__prefixList = prefixl
+        if prefix != '':
+            # Set after the prefix so the code page can be looked up
+            filename = self._getStringStream(prefixl[:-1] + ['__substg1.0_3001'], prefix = False)
         self.filename = filename
         # Initialize properties in the order that is least likely to cause bugs.
         # TODO have each function check for initialization of needed data so these
@@ -468,7 +846,94 @@ class Message(OleFile.OleFileIO):
         self.header
         self.date
         self.__crlf = '\n' #This variable keeps track of what the new line character should be
-        self.body
+        # The body can be huge, so it is only read when it is asked for
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Closes the message along with every embedded message opened from
+        it and drops the cached attachment data and bodies, so nothing is
+        left for the garbage collector to release. Embedded messages leave
+        the shared file handle for their parent to close. Calling close
+        more than once is harmless.
+        """
+        if self.__closed:
+            return
+        self.__closed = True
+        for child in list(self.__children):
+            child.close()
+        for attachment in self.__dict__.get('_attachments', ()):
+            attachment.release()
+        for name in ('_attachments', '_body', '_htmlBody', '_compressedRtf', '_header'):
+            self.__dict__.pop(name, None)
+        # Whatever is still counted goes back to the parent's budget
+        self._release(self.__memoryUsage)
+        if self.__parent is None:
+            OleFile.OleFileIO.close(self)
+        else:
+            if self in self.__parent.__children:
+                self.__parent.__children.remove(self)
+            self.fp = None
+
+    @property
+    def closed(self):
+        return self.__closed
+
+    @property
+    def memoryBudget(self):
+        if self.__parent is not None:
+            return self.__parent.memoryBudget
+        return self.__memoryBudget
+
+    @property
+    def spillThreshold(self):
+        return self.__spillThreshold
+
+    @property
+    def memoryUsage(self):
+        """
+        Bytes of stream data currently held in memory. Embedded messages
+        report the total of their top level message.
+        """
+        if self.__parent is not None:
+            return self.__parent.memoryUsage
+        return self.__memoryUsage
+
+    @property
+    def peakMemory(self):
+        """
+        The highest `memoryUsage` reached, which stays available after
+        the message is closed.
+        """
+        if self.__parent is not None:
+            return self.__parent.peakMemory
+        return self.__peakMemory
+
+    def _reserve(self, size):
+        # Embedded messages count what they and their own children hold,
+        # and the top level message checks the total against the budget
+        if self.__parent is not None:
+            self.__parent._reserve(size)
+        elif self.__memoryBudget is not None and self.__memoryUsage + size > self.__memoryBudget:
+            raise MemoryBudgetError('Reading a stream of {0} bytes would take the message over its memory budget '
+                                    'of {1} bytes ({2} bytes already in memory)'.format(size, self.__memoryBudget,
+                                                                                         self.__memoryUsage))
+        self.__memoryUsage += size
+        self.__peakMemory = max(self.__peakMemory, self.__memoryUsage)
+
+    def _release(self, size):
+        # Never more than is counted, so releasing after close is harmless
+        size = min(size, self.__memoryUsage)
+        if size <= 0:
+            return
+        self.__memoryUsage -= size
+        if self.__parent is not None:
+            self.__parent._release(size)
 
     def listDir(self, streams = True, storages = False):
         temp = self.listdir(streams, storages)
@@ -503,17 +968,68 @@ class Message(OleFile.OleFileIO):
         if prefix:
             filename = self.__prefix + filename
         if self.exists(filename):
-            stream = self.openstream(filename)
-            return stream.read()
+            # olefile holds its own copy of the stream while read() makes
+            # the one returned, so twice the size is needed until then
+            size = self.get_size(filename)
+            self._reserve(2 * size)
+            try:
+                data = self.openstream(filename).read()
+            except Exception:
+                self._release(2 * size)
+                raise
+            self._release(size)
+            return data
         else:
             return None
 
+    def getStreamSize(self, filename, prefix = True):
+        if isinstance(filename, list):
+            filename = '/'.join(filename)
+        if prefix:
+            filename = self.__prefix + filename
+        return self.get_size(filename)
+
+    def iterStream(self, filename, chunkSize = CHUNK_SIZE, prefix = True):
+        """
+        Yields the stream in chunks without reading it into memory at once.
+        See the module level iterStream.
+        """
+        if isinstance(filename, list):
+            filename = '/'.join(filename)
+        if prefix:
+            filename = self.__prefix + filename
+        return iterStream(self, filename, chunkSize)
+
+    def openStream(self, filename, prefix = True):
+        """
+        Returns a file object holding the stream. Streams up to
+        `spillThreshold` bytes are read into memory and count against the
+        memory budget until the file object is closed; bigger ones, and any
+        that would not fit in what is left of the budget while being read,
+        are copied in chunks to a temporary file.
+        """
+        size = self.getStreamSize(filename, prefix)
+        budget = self.memoryBudget
+        if size <= self.__spillThreshold and (budget is None or self.memoryUsage + 2 * size <= budget):
+            return _BudgetedBytesIO(self, self._getStream(filename, prefix))
+        import tempfile
+        f = tempfile.TemporaryFile()
+        try:
+            for chunk in self.iterStream(filename, prefix = prefix):
+                f.write(chunk)
+            f.seek(0)
+        except Exception:
+            f.close()
+            raise
+        return f
+
     def _getStringStream(self, filename, prefer = 'unicode', prefix = True):
         """Gets a string representation of the requested filename.
         Checks for both ASCII and Unicode representations and returns
         a value if possible.  If there are both ASCII and Unicode
         versions, then the parameter /prefer/ specifies which will be
-        returned.
+        returned.  Either way the value is text: ASCII versions are
+        decoded with the message's code page.
         """
 
         if isinstance(filename, list):
@@ -521,6 +1037,8 @@ class Message(OleFile.OleFileIO):
             filename = '/'.join(filename)
 
         asciiVersion = self._getStream(filename + '001E', prefix)
+        if asciiVersion is not None:
+            asciiVersion = getDecoder(self.codepage)(asciiVersion)
         unicodeVersion = windowsUnicode(self._getStream(filename + '001F', prefix))
         if asciiVersion is None:
             return unicodeVersion
@@ -540,6 +1058,25 @@ class Message(OleFile.OleFileIO):
     def prefix(self):
         return self.__prefix
 
+    @property
+    def codepage(self):
+        """
+        The code page of the message's 8 bit (001E) string properties:
+        the message code page (3FFD) if set, otherwise the Internet code
+        page (3FDE), otherwise `DEFAULT_CODEPAGE`.
+        """
+        try:
+            return self._codepage
+        except AttributeError:
+            props = self.mainProperties.props
+            if '3FFD0003' in props:
+                self._codepage = props['3FFD0003'].value & 0xFFFFFFFF
+            elif '3FDE0003' in props:
+                self._codepage = props['3FDE0003'].value & 0xFFFFFFFF
+            else:
+                self._codepage = DEFAULT_CODEPAGE
+            return self._codepage
+
     @property
     def prefixList(self):
         return self.__prefixList
@@ -549,7 +1086,7 @@ class Message(OleFile.OleFileIO):
         try:
             return self._subject
         except:
-            self._subject = encode(self._getStringStream('__substg1.0_0037'))
+            self._subject = self._getStringStream('__substg1.0_0037')
             return self._subject
 
     @property
@@ -559,6 +1096,7 @@ class Message(OleFile.OleFileIO):
         except Exception:
             headerText = self._getStringStream('__substg1.0_007D')
             if headerText is not None:
+                from email.parser import Parser as EmailParser
                 self._header = EmailParser().parsestr(headerText)
                 self._header['date'] = self.date
             else:
@@ -598,6 +1136,7 @@ class Message(OleFile.OleFileIO):
 
     @property
     def parsedDate(self):
+        import email.utils
         return email.utils.parsedate(self.date)
 
     @property
@@ -644,7 +1183,7 @@ class Message(OleFile.OleFileIO):
                     st = f[0]
                     if len(f) > 1:
                         for x in range(1, len(f)):
-                            st = st + '; {0}'.format(f[x])
+                            st = st + u'; {0}'.format(f[x])
                     self._to = st
                 else:
                     self._to = None
@@ -685,7 +1224,7 @@ class Message(OleFile.OleFileIO):
                     st = f[0]
                     if len(f) > 1:
                         for x in range(1, len(f)):
-                            st = st + '; {0}'.format(f[x])
+                            st = st + u'; {0}'.format(f[x])
                     self._cc = st
                 else:
                     self._cc = None
@@ -697,11 +1236,9 @@ class Message(OleFile.OleFileIO):
         try:
             return self._body
         except Exception:
-            self._body = encode(self._getStringStream('__substg1.0_1000'))
-            a = re.search('\n', self._body)
-            if a != None:
-                if re.search('\r\n', self._body) != None:
-                    self.__crlf = '\r\n'
+            self._body = self._getStringStream('__substg1.0_1000')
+            if self._body is not None and '\r\n' in self._body:
+                self.__crlf = '\r\n'
             return self._body
 
     @property
@@ -742,12 +1279,15 @@ class Message(OleFile.OleFileIO):
 
             return self._recipients
 
-    def save(self, toJson=False, useFileName=False, raw=False, ContentId=False):
+    def save(self, toJson=False, useFileName=False, raw=False, ContentId=False, outputDir=None):
         '''Saves the message body and attachments found in the message.  Setting toJson
         to true will output the message body as JSON-formatted text.  The body and
         attachments are stored in a folder.  Setting useFileName to true will mean that
         the filename is used as the name of the folder; otherwise, the message's date
-        and subject are used as the folder name.'''
+        and subject are used as the folder name.  Attachments are written to outputDir,
+        or the current directory if it is not given, and the current directory is never
+        changed, so messages can be saved from several threads at once.  Returns the
+        paths of the saved attachments, including those of embedded messages.'''
 
         if useFileName:
             # strip out the extension
@@ -767,7 +1307,6 @@ class Message(OleFile.OleFileIO):
 
             dirName = dirName + ' ' + subject
 
-        oldDir = os.getcwd()
         try:
             
             #os.chdir(dirName)
@@ -782,9 +1321,14 @@ class Message(OleFile.OleFileIO):
             attachmentNames = []
             # Save the attachments
             for attachment in self.attachments:
-                attachmentNames.append(attachment.save(ContentId))
+                saved = attachment.save(ContentId, outputDir = outputDir)
+                if attachment.type == 'msg':
+                    attachmentNames.extend(saved)
+                else:
+                    attachmentNames.append(saved)
 
             if toJson:
+                import json
 
                 emailObj = {'from': xstr(self.sender),
                             'to': xstr(self.to),
@@ -792,63 +1336,57 @@ class Message(OleFile.OleFileIO):
                             'subject': xstr(self.subject),
                             'date': xstr(self.date),
                             'attachments': attachmentNames,
-                            'body': decode_utf7(self.body),
-                            'urls': re.findall('https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+', decode_utf7(self.body))}
+                            'body': xstr(self.body),
+                            'urls': re.findall('https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+', xstr(self.body))}
 
-                print json.dumps(emailObj, ensure_ascii=True)
+                print(json.dumps(emailObj, ensure_ascii=True))
             else:
-                print('From: ' + xstr(self.sender) + self.__crlf)
-                print('To: ' + xstr(self.to) + self.__crlf)
-                print('CC: ' + xstr(self.cc) + self.__crlf)
-                print('Subject: ' + xstr(self.subject) + self.__crlf)
-                print('Date: ' + xstr(self.date) + self.__crlf)
+                # Reading the body first settles the line ending to use
+                body = xstr(self.body)
+                print(encode('From: ' + xstr(self.sender) + self.__crlf))
+                print(encode('To: ' + xstr(self.to) + self.__crlf))
+                print(encode('CC: ' + xstr(self.cc) + self.__crlf))
+                print(encode('Subject: ' + xstr(self.subject) + self.__crlf))
+                print(encode('Date: ' + xstr(self.date) + self.__crlf))
                 print('-----------------' + self.__crlf + self.__crlf)
-                print(self.body)
+                print(encode(body))
+
+            return attachmentNames
 
 
         except Exception as e:
-            self.saveRaw()
+            self.saveRaw(outputDir)
             raise
 
-        finally:
-            # Return to previous directory
-            os.chdir(oldDir)
-
-    def saveRaw(self):
-        # Create a 'raw' folder
-        oldDir = os.getcwd()
-        try:
-            rawDir = 'raw'
-            os.makedirs(rawDir)
-            os.chdir(rawDir)
-            sysRawDir = os.getcwd()
-
-            # Loop through all the directories
-            for dir_ in self.listdir():
-                sysdir = '/'.join(dir_)
-                code = dir_[-1][-8:-4]
-                global properties
-                if code in properties:
-                    sysdir = sysdir + ' - ' + properties[code]
-                os.makedirs(sysdir)
-                os.chdir(sysdir)
-
-                # Generate appropriate filename
-                if dir_[-1].endswith('001E'):
-                    filename = 'contents.txt'
-                else:
-                    filename = 'contents'
+    def saveRaw(self, outputDir=None):
+        # Create a 'raw' folder, or 'raw (n)' if there already is one
+        sysRawDir = os.path.abspath(makeUniqueDir(os.path.join(outputDir or '', 'raw')))
+
+        # Loop through all the directories
+        for dir_ in self.listdir():
+            sysdir = '/'.join(dir_)
+            code = dir_[-1][-8:-4]
+            global properties
+            if code in properties:
+                sysdir = sysdir + ' - ' + properties[code]
+            sysdir = os.path.join(sysRawDir, sysdir)
+            os.makedirs(sysdir)
+
+            # Generate appropriate filename
+            if dir_[-1].endswith('001E'):
+                filename = 'contents.txt'
+            else:
+                filename = 'contents'
 
-                # Save contents of directory
-                f = open(filename, 'wb')
-                f.write(self._getStream(dir_))
+            # Save contents of directory
+            f = open(os.path.join(sysdir, filename), 'wb')
+            try:
+                for chunk in iterStream(self, dir_):
+                    f.write(chunk)
+            finally:
                 f.close()
 
-                # Return to base directory
-                os.chdir(sysRawDir)
-
-        finally:
-            os.chdir(oldDir)
+        return sysRawDir
 
     def dump(self):
         ## Prints out a summary of the message
@@ -861,14 +1399,1124 @@ class Message(OleFile.OleFileIO):
     def debug(self):
         for dir_ in self.listDir():
             if dir_[-1].endswith('001E') or dir_[-1].endswith('001F'):
+                # Read directly so debugging never counts against the memory budget
+                data = self.openstream(dir_).read()
+                if dir_[-1].endswith('001F'):
+                    data = windowsUnicode(data)
+                else:
+                    data = getDecoder(self.codepage)(data)
                 print('Directory: ' + str(dir_[:-1]))
-                print('Contents: ' + self._getStream(dir_))
+                print('Contents: ' + encode(data))
 
-    def save_attachments(self, contentId = False, json = False, useFileName = False, raw = False):
-        """Saves only attachments in the same folder.
+    def save_attachments(self, contentId = False, json = False, useFileName = False, raw = False, outputDir = None):
+        """Saves only attachments in the same folder, `outputDir` if given.
+        Returns the paths written.
         """
+        paths = []
         for attachment in self.attachments:
-            attachment.save(contentId, json, useFileName, raw)
+            saved = attachment.save(contentId, json, useFileName, raw, outputDir)
+            if attachment.type == 'msg':
+                paths.extend(saved)
+            else:
+                paths.append(saved)
+        return paths
+
+class MessagePool:
+    """
+    Bounds the number of messages open at once when many are extracted
+    concurrently from threads in one process. `open` waits while
+    `maxOpen` messages are open and closes each message (with everything
+    embedded in it) as soon as the caller is done with it, so file handles
+    and memory stay flat however many files go through the pool. Batch
+    runs do not need it, as each worker process holds one message at a
+    time:
+
+        pool = MessagePool(16)
+        with pool.open(filename) as msg:
+            msg.save_attachments(outputDir = out)
+    """
+    def __init__(self, maxOpen = 16, attachmentClass = Attachment):
+        import threading
+        self.__maxOpen = maxOpen
+        self.__attachmentClass = attachmentClass
+        self.__slots = threading.BoundedSemaphore(maxOpen)
+
+    @property
+    def maxOpen(self):
+        return self.__maxOpen
+
+    @contextlib.contextmanager
+    def open(self, filename):
+        self.__slots.acquire()
+        try:
+            with Message(filename, attachmentClass = self.__attachmentClass) as msg:
+                yield msg
+        finally:
+            self.__slots.release()
+
+SNIFF_SIZE = 512
+
+_magicNumbers = [
+    (OleFile.MAGIC, 'ole'),
+    (b'PK\x03\x04', 'zip'),
+    (b'PK\x05\x06', 'zip'),
+    (b'\x1f\x8b', 'gzip'),
+    (b'%PDF', 'pdf'),
+    (b'Rar!\x1a\x07', 'rar'),
+    (b'7z\xbc\xaf\x27\x1c', '7z'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF8', 'gif'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+    (b'{\\rtf', 'rtf'),
+]
+
+_emlHeaders = re.compile(br'^(received|return-path|from|to|subject|date|message-id|mime-version|content-type|x-[a-z0-9-]+):[ \t]',
+                         re.IGNORECASE | re.MULTILINE)
+
+def sniffType(head):
+    """
+    Guesses the type of a file from its first bytes (`SNIFF_SIZE` is
+    plenty). Returns a short name such as 'ole', 'zip', 'eml', 'pdf' or
+    'data' if nothing matched.
+    """
+    for magic, kind in _magicNumbers:
+        if head.startswith(magic):
+            return kind
+    if re.match(br'[A-Za-z0-9-]+:[ \t]', head) and len(_emlHeaders.findall(head)) >= 2:
+        return 'eml'
+    return 'data'
+
+def expandMessage(msg, maxDepth = 5, maxSize = 64 * 1024 * 1024):
+    """
+    Walks the attachments of `msg` in memory, sniffing each one and
+    expanding the ones that are themselves containers: embedded and
+    attached .msg files, other OLE files, zip archives and .eml messages.
+    Nothing is written to disk. Returns a flat list with one dictionary
+    per item found, giving its 'path' (the names leading to it joined
+    with '/'), 'name', 'kind', 'size' and 'depth', and whether it was
+    'expanded'. Containers deeper than `maxDepth` or bigger than
+    `maxSize` bytes are listed but not opened.
+    """
+    items = []
+    _expandMessage(msg, '', 1, items, maxDepth, maxSize)
+    return items
+
+def _addItem(items, parent, name, kind, size, depth):
+    item = {'path': parent + name, 'name': name, 'kind': kind, 'size': size,
+            'depth': depth, 'expanded': False}
+    items.append(item)
+    return item
+
+def _expandMessage(msg, parent, depth, items, maxDepth, maxSize):
+    for attachment in msg.attachments:
+        name = toUnicode(attachment.longFilename or attachment.shortFilename or attachment.cid) or u'UnknownFilename'
+        if attachment.type == 'msg':
+            item = _addItem(items, parent, name, 'msg', None, depth)
+            if depth < maxDepth:
+                embedded = attachment.openEmbeddedMessage()
+                try:
+                    _expandMessage(embedded, item['path'] + u'/', depth + 1, items, maxDepth, maxSize)
+                finally:
+                    embedded.close()
+                item['expanded'] = True
+        elif attachment.type == 'container':
+            prefix = attachment.prefixList
+            entries = [x for x in msg.listdir() if x[:len(prefix)] == prefix and len(x) > len(prefix)]
+            item = _addItem(items, parent, name, 'ole', sum(msg.get_size('/'.join(x)) for x in entries), depth)
+            if depth < maxDepth:
+                for entry in entries:
+                    _addItem(items, item['path'] + u'/', toUnicode('/'.join(entry[len(prefix):])), 'stream',
+                             msg.get_size('/'.join(entry)), depth + 1)
+                item['expanded'] = True
+        else:
+            # Only the first chunk is read unless the attachment turns out
+            # to be a container small enough to open
+            kind = sniffType(attachment.head(SNIFF_SIZE))
+            size = attachment.size
+            if kind in ('ole', 'zip', 'eml') and depth < maxDepth and size <= maxSize:
+                try:
+                    _expandData(msg, attachment.data, name, parent, depth, items, maxDepth, maxSize, kind)
+                finally:
+                    attachment.release()
+            else:
+                _addItem(items, parent, name, kind, size, depth)
+
+def _expandData(msg, data, name, parent, depth, items, maxDepth, maxSize, kind = None):
+    if kind is None:
+        kind = sniffType(data[:SNIFF_SIZE])
+    item = _addItem(items, parent, name, kind, len(data), depth)
+    if depth >= maxDepth or len(data) > maxSize:
+        return
+    path = item['path'] + u'/'
+    try:
+        if kind == 'ole':
+            ole = OleFile.OleFileIO(io.BytesIO(data))
+            try:
+                isMsg = ole.exists('__properties_version1.0') and \
+                    (ole.exists('__substg1.0_001A001F') or ole.exists('__substg1.0_001A001E'))
+                if not isMsg:
+                    for entry in ole.listdir():
+                        _addItem(items, path, toUnicode('/'.join(entry)), 'stream', ole.get_size(entry), depth + 1)
+            finally:
+                ole.close()
+            if isMsg:
+                item['kind'] = 'msg'
+                # The nested message gets what is left of the memory budget
+                budget = msg.memoryBudget
+                if budget is not None:
+                    budget = max(budget - msg.memoryUsage, 0)
+                embedded = Message(io.BytesIO(data), memoryBudget = budget, spillThreshold = msg.spillThreshold)
+                try:
+                    _expandMessage(embedded, path, depth + 1, items, maxDepth, maxSize)
+                finally:
+                    embedded.close()
+        elif kind == 'zip':
+            import zipfile
+            archive = zipfile.ZipFile(io.BytesIO(data))
+            try:
+                for info in archive.infolist():
+                    if info.filename.endswith('/'):
+                        continue
+                    if info.file_size > maxSize:
+                        _addItem(items, path, toUnicode(info.filename), 'data', info.file_size, depth + 1)
+                    else:
+                        msg._reserve(info.file_size)
+                        try:
+                            _expandData(msg, archive.read(info), toUnicode(info.filename), path, depth + 1, items,
+                                        maxDepth, maxSize)
+                        finally:
+                            msg._release(info.file_size)
+            finally:
+                archive.close()
+        elif kind == 'eml':
+            import email
+            # The parsed message holds another copy of the data
+            msg._reserve(len(data))
+            try:
+                parsed = getattr(email, 'message_from_bytes', email.message_from_string)(data)
+                for part in parsed.walk():
+                    if part.is_multipart():
+                        continue
+                    partName = part.get_filename()
+                    if partName is None:
+                        continue
+                    payload = part.get_payload(decode = True) or b''
+                    msg._reserve(len(payload))
+                    try:
+                        _expandData(msg, payload, toUnicode(partName), path, depth + 1, items, maxDepth, maxSize)
+                    finally:
+                        msg._release(len(payload))
+            finally:
+                msg._release(len(data))
+        else:
+            return
+    except MemoryBudgetError:
+        raise
+    except Exception:
+        # A damaged container is still listed, just not expanded
+        return
+    item['expanded'] = True
+
+class MessageIndex:
+    """
+    A local SQLite full text index over one or more directories of .msg
+    files. The sender, to, cc, subject, date and attachment names of every
+    message (and optionally the body) are stored once so that later
+    searches do not need to reopen the messages. Calling `update` again
+    only reindexes files that are new or have changed since the last run.
+    """
+    def __init__(self, path, indexBody = False):
+        self.__path = path
+        self.__indexBody = indexBody
+        import sqlite3
+        self.__db = sqlite3.connect(path)
+        self.__db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                mtime REAL,
+                size INTEGER,
+                docid INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS attachments (
+                docid INTEGER,
+                name TEXT,
+                size INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS attachments_docid ON attachments (docid);
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts4 (
+                path, sender, "to", cc, subject, date, attachments, body
+            );
+        """)
+
+    @property
+    def path(self):
+        return self.__path
+
+    def close(self):
+        self.__db.close()
+
+    def update(self, directory):
+        """
+        Walks `directory` and brings the index up to date with it. Files
+        whose size and modification time have not changed are skipped and
+        files which no longer exist are dropped from the index. Returns a
+        dictionary counting the added, updated, unchanged and removed files.
+        """
+        counts = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+        root = toUnicode(os.path.abspath(directory))
+        seen = set()
+        for dirPath, dirNames, fileNames in os.walk(directory):
+            for name in fileNames:
+                if not name.lower().endswith('.msg'):
+                    continue
+                filename = os.path.abspath(os.path.join(dirPath, name))
+                key = toUnicode(filename)
+                seen.add(key)
+                st = os.stat(filename)
+                row = self.__db.execute('SELECT mtime, size, docid FROM files WHERE path = ?', (key,)).fetchone()
+                if row is not None:
+                    if row[0] == st.st_mtime and row[1] == st.st_size:
+                        counts['unchanged'] += 1
+                        continue
+                    self.__remove(key, row[2])
+                    counts['updated'] += 1
+                else:
+                    counts['added'] += 1
+                self.__db.execute('INSERT INTO files (path, mtime, size, docid) VALUES (?, ?, ?, ?)',
+                                  (key, st.st_mtime, st.st_size, self.__add(filename, key)))
+            self.__db.commit()
+
+        prefix = root.rstrip(os.sep) + os.sep
+        for key, docid in self.__db.execute('SELECT path, docid FROM files').fetchall():
+            if key.startswith(prefix) and key not in seen:
+                self.__remove(key, docid)
+                counts['removed'] += 1
+        self.__db.commit()
+        return counts
+
+    def __add(self, filename, key):
+        try:
+            msg = Message(filename)
+        except Exception:
+            # Remember broken files too so they are not retried until they change
+            return None
+        try:
+            names = []
+            sizes = []
+            for attachment in msg.attachments:
+                name = attachment.longFilename or attachment.shortFilename
+                names.append(toUnicode(name) or '')
+                sizes.append(attachment.size)
+            body = toUnicode(msg.body) if self.__indexBody else None
+            cursor = self.__db.execute(
+                'INSERT INTO messages (path, sender, "to", cc, subject, date, attachments, body) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, toUnicode(msg.sender), toUnicode(msg.to), toUnicode(msg.cc), toUnicode(msg.subject),
+                 toUnicode(msg.date), ' '.join(names), body))
+            docid = cursor.lastrowid
+            self.__db.executemany('INSERT INTO attachments (docid, name, size) VALUES (?, ?, ?)',
+                                  [(docid, names[x], sizes[x]) for x in range(len(names))])
+            return docid
+        finally:
+            msg.close()
+
+    def __remove(self, key, docid):
+        if docid is not None:
+            self.__db.execute('DELETE FROM messages WHERE docid = ?', (docid,))
+            self.__db.execute('DELETE FROM attachments WHERE docid = ?', (docid,))
+        self.__db.execute('DELETE FROM files WHERE path = ?', (key,))
+
+    def search(self, query):
+        """
+        Returns the paths of the indexed messages matching the full text
+        `query`. Columns can be targeted with the usual FTS syntax, for
+        example 'sender:walker' or 'attachments:report'.
+        """
+        return [x[0] for x in self.__db.execute('SELECT path FROM messages WHERE messages MATCH ?', (toUnicode(query),))]
+
+    def attachments(self, path):
+        """
+        Returns a list of (name, size) tuples for the attachments of the
+        indexed message at `path`. The size is None for embedded messages.
+        """
+        return self.__db.execute(
+            'SELECT a.name, a.size FROM attachments a JOIN files f ON a.docid = f.docid WHERE f.path = ?',
+            (toUnicode(os.path.abspath(path)),)).fetchall()
+
+class MessageFilter:
+    """
+    Predicates for deciding whether a .msg file is worth extracting at all.
+    Each predicate is checked with the cheapest read that can answer it:
+    the size comes from the file system, the date and attachment flag from
+    the top level properties stream and the message class and sender from
+    single string streams. Nothing else in the file is read.
+
+    `after` and `before` are naive UTC datetimes compared against the
+    client submit time (00390040). `messageClass` matches the class itself
+    and any of its subclasses, so 'IPM.Note' also matches 'IPM.Note.SMIME'.
+    `senderDomain` matches the domain and its subdomains.
+    """
+    def __init__(self, after = None, before = None, messageClass = None, senderDomain = None,
+                 hasAttachments = None, minSize = None, maxSize = None):
+        self.after = after
+        self.before = before
+        self.messageClass = messageClass
+        self.senderDomain = senderDomain
+        self.hasAttachments = hasAttachments
+        self.minSize = minSize
+        self.maxSize = maxSize
+
+    @property
+    def active(self):
+        return any(x is not None for x in (self.after, self.before, self.messageClass, self.senderDomain,
+                                           self.hasAttachments, self.minSize, self.maxSize))
+
+    def matches(self, filename):
+        if self.minSize is not None or self.maxSize is not None:
+            size = os.path.getsize(filename)
+            if self.minSize is not None and size < self.minSize:
+                return False
+            if self.maxSize is not None and size > self.maxSize:
+                return False
+        if self.after is None and self.before is None and self.hasAttachments is None and \
+                self.messageClass is None and self.senderDomain is None:
+            return True
+
+        ole = OleFile.OleFileIO(filename)
+        try:
+            if self.after is not None or self.before is not None or self.hasAttachments is not None:
+                props = Properties(ole.openstream('__properties_version1.0').read()).props
+                if self.after is not None or self.before is not None:
+                    if '00390040' not in props:
+                        return False
+                    date = datetime.datetime.utcfromtimestamp(msgEpoch(props['00390040'].value))
+                    if self.after is not None and date < self.after:
+                        return False
+                    if self.before is not None and date >= self.before:
+                        return False
+                if self.hasAttachments is not None:
+                    if '0E1B000B' in props:
+                        flag = props['0E1B000B'].value & 0x1 != 0
+                    elif '0E070003' in props:
+                        flag = props['0E070003'].value & 0x10 != 0
+                    else:
+                        flag = False
+                    if flag != self.hasAttachments:
+                        return False
+
+            if self.messageClass is not None:
+                messageClass = (readStringStream(ole, '__substg1.0_001A') or '').lower()
+                wanted = self.messageClass.lower()
+                if messageClass != wanted and not messageClass.startswith(wanted + '.'):
+                    return False
+
+            if self.senderDomain is not None:
+                address = readStringStream(ole, '__substg1.0_5D01') or \
+                    readStringStream(ole, '__substg1.0_0C1F') or ''
+                domain = address.rpartition('@')[2].strip().rstrip('>').lower()
+                wanted = self.senderDomain.lower().lstrip('@')
+                if domain != wanted and not domain.endswith('.' + wanted):
+                    return False
+            return True
+        finally:
+            ole.close()
+
+def readStringStream(ole, filename, codepage = DEFAULT_CODEPAGE):
+    """
+    Reads a string property straight from an open OleFileIO, preferring
+    the Unicode version and decoding the ASCII version with `codepage`.
+    For cheap reads that should not construct a whole Message.
+    """
+    if ole.exists(filename + '001F'):
+        return windowsUnicode(ole.openstream(filename + '001F').read())
+    if ole.exists(filename + '001E'):
+        return getDecoder(codepage)(ole.openstream(filename + '001E').read())
+    return None
+
+def fingerprint(filename):
+    """
+    Returns a hex digest identifying a message whichever copy of it is
+    read, so that forwarded copies and re-exports can be recognized
+    without extracting them. Only the properties stream and a handful of
+    other streams are read: the Internet Message-ID, the submit date
+    (00390040), the sender, the subject, the body and the attachment data.
+    """
+    import hashlib
+    ole = OleFile.OleFileIO(filename)
+    try:
+        digest = hashlib.sha1()
+        props = Properties(ole.openstream('__properties_version1.0').read()).props
+        codepage = DEFAULT_CODEPAGE
+        for code in ('3FFD0003', '3FDE0003'):
+            if code in props:
+                codepage = props[code].value & 0xFFFFFFFF
+                break
+        for name in ('__substg1.0_1035', '__substg1.0_5D01', '__substg1.0_0C1F', '__substg1.0_0C1A',
+                     '__substg1.0_0037', '__substg1.0_1000'):
+            digest.update((readStringStream(ole, name, codepage) or u'').strip().encode('utf8'))
+            digest.update(b'\0')
+        if '00390040' in props:
+            digest.update(str(props['00390040'].value).encode('ascii'))
+
+        entries = ole.listdir()
+        for dir_ in sorted(set(x[0] for x in entries if x[0].startswith('__attach'))):
+            digest.update(b'\0')
+            if ole.exists(dir_ + '/__substg1.0_37010102'):
+                data = hashlib.sha1()
+                for chunk in iterStream(ole, dir_ + '/__substg1.0_37010102'):
+                    data.update(chunk)
+                digest.update(data.digest())
+            else:
+                # Embedded messages are summarized by the sizes of their streams
+                for entry in sorted(x for x in entries if x[0] == dir_):
+                    digest.update('{0}={1};'.format('/'.join(entry[1:]), ole.get_size(entry)).encode('ascii'))
+        return digest.hexdigest()
+    finally:
+        ole.close()
+
+def _processAlive(pid):
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows, so assume it runs
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class FingerprintStore:
+    """
+    A local SQLite store of message fingerprints for skipping duplicate
+    messages across batch runs. It can be shared by several processes.
+    A file checked in as the original is only taken as extracted once
+    `confirm` is called; until then it is pending, owned by the process
+    extracting it.
+    """
+    def __init__(self, path):
+        import sqlite3
+        self.__path = path
+        self.__db = sqlite3.connect(path, timeout = 60)
+        # Taking the write lock first keeps stores opened at the same time
+        # from tripping over each other's schema changes
+        self.__db.executescript("""
+            BEGIN IMMEDIATE;
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                fingerprint TEXT PRIMARY KEY,
+                path TEXT,
+                owner INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS duplicates (
+                path TEXT PRIMARY KEY,
+                original TEXT
+            );
+            COMMIT;
+        """)
+        # Stores made before originals could be pending have no owner column
+        if 'owner' not in [x[1] for x in self.__db.execute('PRAGMA table_info(fingerprints)')]:
+            try:
+                with self.__db:
+                    self.__db.execute('ALTER TABLE fingerprints ADD COLUMN owner INTEGER')
+            except sqlite3.OperationalError:
+                # Another process added it first
+                pass
+
+    @property
+    def path(self):
+        return self.__path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.__db.close()
+
+    def check(self, filename, fingerprint, timeout = 600):
+        """
+        Looks up `fingerprint`. If another file was extracted with it first,
+        `filename` is linked to that file as a duplicate and the original's
+        path is returned. Otherwise `filename` is claimed as the pending
+        original and None is returned; the caller then has to `confirm` it
+        once extracted or `forget` it if extraction failed. While another
+        process is still extracting the original this waits for it, for up
+        to `timeout` seconds. A claim left by a process that died is taken
+        over.
+        """
+        key = toUnicode(os.path.abspath(filename))
+        pid = os.getpid()
+        end = time.time() + timeout
+        while True:
+            with self.__db:
+                self.__db.execute('INSERT OR IGNORE INTO fingerprints (fingerprint, path, owner) VALUES (?, ?, ?)',
+                                  (fingerprint, key, pid))
+                original, owner = self.__db.execute('SELECT path, owner FROM fingerprints WHERE fingerprint = ?',
+                                                    (fingerprint,)).fetchone()
+                if original == key or (owner is not None and (not _processAlive(owner) or time.time() >= end)):
+                    self.__db.execute('UPDATE fingerprints SET path = ?, owner = ? WHERE fingerprint = ?',
+                                      (key, pid, fingerprint))
+                    return None
+                if owner is None:
+                    self.__db.execute('INSERT OR REPLACE INTO duplicates (path, original) VALUES (?, ?)', (key, original))
+                    return original
+            time.sleep(0.1)
+
+    def confirm(self, filename, fingerprint):
+        """
+        Records that `filename`, claimed as the original by `check`, was
+        extracted, so later files with `fingerprint` are its duplicates.
+        """
+        with self.__db:
+            self.__db.execute('UPDATE fingerprints SET owner = NULL WHERE fingerprint = ? AND path = ?',
+                              (fingerprint, toUnicode(os.path.abspath(filename))))
+
+    def forget(self, filename, fingerprint):
+        """
+        Drops `fingerprint` if `filename` was recorded as its original, so
+        the next file with it is treated as new. Used when extracting the
+        original failed.
+        """
+        with self.__db:
+            self.__db.execute('DELETE FROM fingerprints WHERE fingerprint = ? AND path = ?',
+                              (fingerprint, toUnicode(os.path.abspath(filename))))
+
+    def duplicates(self):
+        """
+        Returns a list of (path, original path) tuples for every duplicate
+        found so far.
+        """
+        return self.__db.execute('SELECT path, original FROM duplicates').fetchall()
+
+def isOleFile(filename):
+    """
+    Checks the magic header of `filename` without parsing anything else,
+    so that non-OLE files can be skipped before they are handed to olefile.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(OleFile.MAGIC)) == OleFile.MAGIC
+    except (IOError, OSError):
+        return False
+
+def scanTree(root, recursive = True):
+    """
+    Yields the paths of the files in `root` as they are discovered, rather
+    than listing the whole tree first. Subdirectories are only entered if
+    `recursive` is set. Symlinked directories are not followed.
+    """
+    if hasattr(os, 'scandir'):
+        stack = [root]
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks = False):
+                    if recursive:
+                        stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path
+    else:
+        # os.walk lists one directory at a time, which is the closest
+        # Python 2 gets to scandir
+        for dirPath, dirNames, fileNames in os.walk(root):
+            for name in fileNames:
+                yield os.path.join(dirPath, name)
+            if not recursive:
+                del dirNames[:]
+
+def scanManifest(stream):
+    """
+    Yields the paths listed in `stream`, one per line.
+    """
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield line
+
+def scan(sources, recursive = False, manifests = ()):
+    """
+    Yields the OLE files found in `sources` followed by those listed in
+    `manifests`. Directories are walked with `scanTree`, anything else is
+    expanded as a glob. A manifest of '-' is read from stdin.
+    """
+    import glob
+
+    def paths():
+        for source in sources:
+            if os.path.isdir(source):
+                for path in scanTree(source, recursive):
+                    yield path
+            else:
+                for path in glob.iglob(source):
+                    yield path
+        for manifest in manifests:
+            if manifest == '-':
+                for path in scanManifest(sys.stdin):
+                    yield path
+            else:
+                with open(manifest, 'r') as stream:
+                    for path in scanManifest(stream):
+                        yield path
+
+    for path in paths():
+        if isOleFile(path):
+            yield path
+
+def _queueWorker(tasks, conn, handler):
+    import traceback
+    while True:
+        path = tasks.get()
+        if path is None:
+            conn.send(None)
+            return
+        # Announce the path first so it can be reported if the worker dies
+        conn.send((path,))
+        try:
+            conn.send((path, handler(path), None))
+        except Exception:
+            conn.send((path, None, traceback.format_exc()))
+
+def processQueue(paths, handler, workers = 1, maxQueued = 64):
+    """
+    Runs `handler` on every path from the iterable `paths` and yields
+    (path, result, error) tuples as they complete, where `error` is the
+    formatted traceback if the handler raised. With more than one worker
+    the paths are fed to worker processes through a queue holding at most
+    `maxQueued` paths, so work starts as soon as the first path is found
+    and a slow producer never has to materialize the full list. A worker
+    that dies (killed for using too much memory, crashed or exited) is
+    replaced, and the path it was handling is reported as failed.
+    """
+    import traceback
+    if workers <= 1:
+        for path in paths:
+            try:
+                yield path, handler(path), None
+            except Exception:
+                yield path, None, traceback.format_exc()
+        return
+
+    import multiprocessing
+    if sys.version_info[0] >= 3:
+        from queue import Full as QueueFull
+        from multiprocessing.connection import wait
+    else:
+        from Queue import Full as QueueFull
+
+        def wait(readers, timeout):
+            end = time.time() + timeout
+            while True:
+                ready = [x for x in readers if x.poll()]
+                if ready or time.time() >= end:
+                    return ready
+                time.sleep(0.01)
+
+    tasks = multiprocessing.Queue(maxQueued)
+    # Maps the reading end of each worker's pipe to [process, path in flight]
+    running = {}
+
+    def startWorker():
+        reader, writer = multiprocessing.Pipe(False)
+        process = multiprocessing.Process(target = _queueWorker, args = (tasks, writer, handler))
+        process.daemon = True
+        process.start()
+        # Only the worker holds the writing end now, so its death shows up as EOF
+        writer.close()
+        running[reader] = [process, None]
+
+    def drain(timeout):
+        out = []
+        while running:
+            ready = wait(list(running), timeout)
+            if not ready:
+                break
+            timeout = 0
+            for reader in ready:
+                try:
+                    message = reader.recv()
+                except EOFError:
+                    process, path = running.pop(reader)
+                    reader.close()
+                    process.join()
+                    if path is not None:
+                        out.append((path, None, 'Worker process exited with code {0}\n'.format(process.exitcode)))
+                        # The path is used up, so a replacement always makes progress
+                        startWorker()
+                    continue
+                if message is None:
+                    running.pop(reader)[0].join()
+                    reader.close()
+                elif len(message) == 1:
+                    running[reader][1] = message[0]
+                else:
+                    running[reader][1] = None
+                    out.append(message)
+        return out
+
+    def put(item, pending):
+        while True:
+            if not running:
+                raise RuntimeError('All worker processes have exited')
+            try:
+                tasks.put(item, True, 0.1)
+                return
+            except QueueFull:
+                pending.extend(drain(0))
+
+    for _ in range(workers):
+        startWorker()
+    try:
+        pending = []
+        for path in paths:
+            put(path, pending)
+            pending.extend(drain(0))
+            for result in pending:
+                yield result
+            pending = []
+        for _ in range(len(running)):
+            put(None, pending)
+        for result in pending:
+            yield result
+        while running:
+            for result in drain(0.1):
+                yield result
+    finally:
+        for reader, (process, path) in running.items():
+            process.terminate()
+            process.join()
+            reader.close()
+
+_fingerprintStores = threading.local()
+
+def _openFingerprintStore(path):
+    # One connection per thread, since sqlite3 connections cannot be shared
+    # between threads, kept for the whole batch run. The process id keeps
+    # a forked worker from reusing its parent's connection.
+    stores = _fingerprintStores.__dict__.setdefault('stores', {})
+    key = (path, os.getpid())
+    if key not in stores:
+        stores[key] = FingerprintStore(path)
+    return stores[key]
+
+def extractFile(filename, writeRaw = False, toJson = False, useFileName = False, msgFilter = None, expand = False,
+                outputDir = None, fingerprintStore = None, memoryBudget = None, spillThreshold = DEFAULT_SPILL_THRESHOLD,
+                memoryReport = False):
+    """
+    Extracts a single .msg file the way the command line does. Returns
+    the list of outputs written, or None if `msgFilter` rejected the file.
+    If extraction fails the string properties are dumped with
+    `Message.debug` and the error is raised again.
+    With `expand` set, the nested contents found by `expandMessage` are
+    printed as JSON instead and nothing is written. If the path of a
+    `FingerprintStore` is given, messages already seen are skipped and
+    {'duplicateOf': path of the original} is returned instead. A message
+    only counts as an original once it was extracted; copies checked
+    while it is still being extracted wait for it.
+    `memoryBudget` and `spillThreshold` are passed on to the Message, and
+    with `memoryReport` set its peak memory use is written to stderr.
+    """
+    if msgFilter is not None and msgFilter.active and not msgFilter.matches(filename):
+        return None
+    store = None
+    if fingerprintStore is not None:
+        store = _openFingerprintStore(fingerprintStore)
+        digest = fingerprint(filename)
+        original = store.check(filename, digest)
+        if original is not None:
+            return {'duplicateOf': original}
+    try:
+        with Message(filename, memoryBudget = memoryBudget, spillThreshold = spillThreshold) as msg:
+            try:
+                if expand:
+                    import json
+                    print(json.dumps({'file': filename, 'items': expandMessage(msg)}))
+                    outputs = []
+                elif writeRaw:
+                    outputs = [msg.saveRaw(outputDir)]
+                else:
+                    outputs = msg.save(toJson, useFileName, outputDir = outputDir)
+            except MemoryBudgetError:
+                raise
+            except Exception:
+                msg.debug()
+                raise
+            finally:
+                if memoryReport:
+                    sys.stderr.write('{0}: peak {1} bytes in memory\n'.format(filename, msg.peakMemory))
+    except Exception:
+        if store is not None:
+            # Let the next copy of this message be extracted instead
+            store.forget(filename, digest)
+        raise
+    if store is not None:
+        store.confirm(filename, digest)
+    return outputs
+
+class Journal:
+    """
+    Append-only checkpoint journal for batch runs. Every completed path is
+    written as one JSON line together with its outputs, and the file is
+    only fsynced every `syncEvery` records or `syncInterval` seconds so the
+    journal does not slow the run down. Opening an existing journal with
+    `resume` set loads the paths it already holds; otherwise the journal
+    is started afresh. A line cut short by a crash is ignored.
+    """
+    def __init__(self, path, resume = False, syncEvery = 100, syncInterval = 5.0):
+        self.__path = path
+        self.__syncEvery = syncEvery
+        self.__syncInterval = syncInterval
+        self.__completed = {}
+        terminated = True
+        import json
+        if resume and os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    terminated = line.endswith('\n')
+                    try:
+                        filename, outputs = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.__completed[filename] = outputs
+        self.__file = open(path, 'a' if resume else 'w')
+        if not terminated:
+            # Keep the next record off the end of a torn line
+            self.__file.write('\n')
+        self.__pending = 0
+        self.__lastSync = time.time()
+
+    @property
+    def path(self):
+        return self.__path
+
+    @property
+    def completed(self):
+        return self.__completed
+
+    def __contains__(self, filename):
+        return os.path.abspath(filename) in self.__completed
+
+    def __len__(self):
+        return len(self.__completed)
+
+    def record(self, filename, outputs):
+        import json
+        filename = os.path.abspath(filename)
+        if isinstance(outputs, list):
+            # Outputs are kept absolute so the journal holds from any directory
+            outputs = [os.path.abspath(x) for x in outputs]
+        self.__completed[filename] = outputs
+        self.__file.write(json.dumps([filename, outputs]) + '\n')
+        self.__pending += 1
+        if self.__pending >= self.__syncEvery or time.time() - self.__lastSync >= self.__syncInterval:
+            self.sync()
+
+    def sync(self):
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__pending = 0
+        self.__lastSync = time.time()
+
+    def close(self):
+        if not self.__file.closed:
+            self.sync()
+            self.__file.close()
+
+def extractRequest(request):
+    """
+    Handles one daemon request and returns a JSON-able result. `request`
+    is a dictionary holding either the 'path' of a .msg file or its
+    base64 encoded 'data', and optionally the options of `Message.save`
+    and `Message.saveRaw`: 'raw', 'useFileName', 'contentId' and
+    'outputDir' (the directory to write to). Set 'attachments' to False
+    to only read the message without writing anything. 'memoryBudget'
+    and 'spillThreshold' are passed on to the Message, and the result
+    reports its 'peakMemory'.
+    """
+    import traceback
+    try:
+        if 'data' in request:
+            import base64
+            # Wrapped so olefile never mistakes short data for a file name
+            filename = io.BytesIO(base64.b64decode(request['data']))
+        else:
+            filename = request['path']
+        with Message(filename, memoryBudget = request.get('memoryBudget'),
+                     spillThreshold = request.get('spillThreshold', DEFAULT_SPILL_THRESHOLD)) as msg:
+            result = {'ok': True,
+                      'path': request.get('path'),
+                      'from': toUnicode(msg.sender),
+                      'to': toUnicode(msg.to),
+                      'cc': toUnicode(msg.cc),
+                      'subject': toUnicode(msg.subject),
+                      'date': toUnicode(msg.date),
+                      'body': toUnicode(msg.body)}
+            outputDir = request.get('outputDir')
+            if request.get('raw', False):
+                result['raw'] = msg.saveRaw(outputDir)
+            elif request.get('attachments', True):
+                result['attachments'] = [os.path.abspath(x) for x in
+                                         msg.save_attachments(request.get('contentId', False),
+                                                              useFileName = request.get('useFileName', False),
+                                                              outputDir = outputDir)]
+            result['peakMemory'] = msg.peakMemory
+            return result
+    except Exception as e:
+        return {'ok': False, 'path': request.get('path'), 'error': str(e), 'traceback': traceback.format_exc()}
+
+def _daemonWorker(conn, maxRequests):
+    handled = 0
+    while maxRequests is None or handled < maxRequests:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        conn.send(extractRequest(request))
+        handled += 1
+
+def serveDaemon(socketPath, workers = 1, maxRequests = None):
+    """
+    Runs a daemon that keeps `workers` warm worker processes and accepts
+    extraction requests on the Unix domain socket `socketPath`. Each line
+    sent to the socket is a JSON request as described in `extractRequest`
+    and is answered by one line holding the JSON result. Workers are
+    replaced after `maxRequests` requests if set, and when they die; the
+    request a dead worker was handling is answered with an error. Runs
+    until interrupted.
+    """
+    import json
+    import multiprocessing
+    import signal
+    import stat
+    if sys.version_info[0] >= 3:
+        import queue as Queue
+        import socketserver as SocketServer
+    else:
+        import Queue
+        import SocketServer
+    # Load the lazily imported modules now so every worker starts warm
+    import base64
+    import traceback
+    import email.parser
+    import email.utils
+
+    # Workers waiting for a request, each as [process, connection, requests handled]
+    idle = Queue.Queue()
+    processes = set()
+
+    def startWorker():
+        conn, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target = _daemonWorker, args = (child, maxRequests))
+        process.daemon = True
+        process.start()
+        # Only the worker holds its end now, so its death shows up as EOF
+        child.close()
+        processes.add(process)
+        return [process, conn, 0]
+
+    def stopWorker(worker):
+        worker[1].close()
+        worker[0].join()
+        processes.discard(worker[0])
+
+    def run(request):
+        worker = idle.get()
+        try:
+            if not worker[0].is_alive():
+                stopWorker(worker)
+                worker = startWorker()
+            try:
+                worker[1].send(request)
+                return worker[1].recv()
+            except (EOFError, IOError, OSError):
+                stopWorker(worker)
+                return {'ok': False, 'path': request.get('path'),
+                        'error': 'Worker process exited with code {0}'.format(worker[0].exitcode)}
+            finally:
+                worker[2] += 1
+                if worker[1].closed or (maxRequests is not None and worker[2] >= maxRequests):
+                    stopWorker(worker)
+                    worker = startWorker()
+        finally:
+            idle.put(worker)
+
+    for _ in range(workers):
+        idle.put(startWorker())
+
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                line = line.strip()
+                if not line:
+                    continue
+                # Every line gets exactly one reply, whatever goes wrong
+                try:
+                    request = json.loads(line.decode('utf8'))
+                except ValueError as e:
+                    result = {'ok': False, 'error': 'Invalid request: {0}'.format(e)}
+                else:
+                    if not isinstance(request, dict):
+                        result = {'ok': False, 'error': 'Invalid request: expected a JSON object'}
+                    else:
+                        try:
+                            result = run(request)
+                        except Exception as e:
+                            result = {'ok': False, 'path': request.get('path'), 'error': str(e)}
+                self.wfile.write(json.dumps(result).encode('utf8') + b'\n')
+                self.wfile.flush()
+
+    class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    try:
+        mode = os.lstat(socketPath).st_mode
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    else:
+        # Only a stale socket is replaced, never anything else
+        if not stat.S_ISSOCK(mode):
+            raise IOError(errno.EEXIST, 'Refusing to replace a file that is not a socket', socketPath)
+        os.remove(socketPath)
+    server = Server(socketPath, Handler)
+    os.chmod(socketPath, 0o600)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for process in list(processes):
+            process.terminate()
+            process.join()
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+
+def requestDaemon(socketPath, request):
+    """
+    Sends one request to a daemon started with `serveDaemon` and returns
+    its result.
+    """
+    import json
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPath)
+        sock.sendall(json.dumps(request).encode('utf8') + b'\n')
+        f = sock.makefile('rb')
+        try:
+            return json.loads(f.readline().decode('utf8'))
+        finally:
+            f.close()
+    finally:
+        sock.close()
 
 
 if __name__ == '__main__':
@@ -878,25 +2526,161 @@ if __name__ == '__main__':
     writeRaw = False
     toJson = False
     useFileName = True
+    indexPath = None
+    indexBody = False
+    searchPath = None
+    msgFilter = MessageFilter()
+    recursive = False
+    manifests = []
+    workers = 1
+    maxQueued = 64
+    journalPath = None
+    resume = False
+    expand = False
+    daemonPath = None
+    maxRequests = None
+    outputDir = None
+    fingerprintStore = None
+    memoryBudget = None
+    spillThreshold = DEFAULT_SPILL_THRESHOLD
+    memoryReport = False
+    args = []
 
     for rawFilename in sys.argv[1:]:
         if rawFilename == '--raw':
             writeRaw = True
 
-        if rawFilename == '--json':
+        elif rawFilename == '--json':
             toJson = True
 
-        if rawFilename == '--use-file-name':
+        elif rawFilename == '--use-file-name':
             useFileName = True
 
-        for filename in glob.glob(rawFilename):
-            msg = Message(filename)
-            try:
-                if writeRaw:
-                    msg.saveRaw()
+        elif rawFilename.startswith('--index='):
+            indexPath = rawFilename[len('--index='):]
+
+        elif rawFilename == '--index-body':
+            indexBody = True
+
+        elif rawFilename.startswith('--search='):
+            searchPath = rawFilename[len('--search='):]
+
+        elif rawFilename.startswith('--after='):
+            msgFilter.after = datetime.datetime.strptime(rawFilename[len('--after='):], '%Y-%m-%d')
+
+        elif rawFilename.startswith('--before='):
+            msgFilter.before = datetime.datetime.strptime(rawFilename[len('--before='):], '%Y-%m-%d')
+
+        elif rawFilename.startswith('--class='):
+            msgFilter.messageClass = rawFilename[len('--class='):]
+
+        elif rawFilename.startswith('--sender-domain='):
+            msgFilter.senderDomain = rawFilename[len('--sender-domain='):]
+
+        elif rawFilename == '--has-attachments':
+            msgFilter.hasAttachments = True
+
+        elif rawFilename == '--no-attachments':
+            msgFilter.hasAttachments = False
+
+        elif rawFilename.startswith('--min-size='):
+            msgFilter.minSize = int(rawFilename[len('--min-size='):])
+
+        elif rawFilename.startswith('--max-size='):
+            msgFilter.maxSize = int(rawFilename[len('--max-size='):])
+
+        elif rawFilename == '--recursive':
+            recursive = True
+
+        elif rawFilename.startswith('--manifest='):
+            manifests.append(rawFilename[len('--manifest='):])
+
+        elif rawFilename.startswith('--workers='):
+            workers = int(rawFilename[len('--workers='):])
+
+        elif rawFilename.startswith('--queue-size='):
+            maxQueued = int(rawFilename[len('--queue-size='):])
+
+        elif rawFilename.startswith('--journal='):
+            journalPath = rawFilename[len('--journal='):]
+
+        elif rawFilename == '--resume':
+            resume = True
+
+        elif rawFilename == '--expand':
+            expand = True
+
+        elif rawFilename.startswith('--daemon='):
+            daemonPath = rawFilename[len('--daemon='):]
+
+        elif rawFilename.startswith('--memory-budget='):
+            memoryBudget = int(rawFilename[len('--memory-budget='):])
+
+        elif rawFilename.startswith('--spill-threshold='):
+            spillThreshold = int(rawFilename[len('--spill-threshold='):])
+
+        elif rawFilename == '--memory-report':
+            memoryReport = True
+
+        elif rawFilename.startswith('--dedupe='):
+            fingerprintStore = rawFilename[len('--dedupe='):]
+
+        elif rawFilename.startswith('--output-dir='):
+            outputDir = rawFilename[len('--output-dir='):]
+
+        elif rawFilename.startswith('--max-requests='):
+            maxRequests = int(rawFilename[len('--max-requests='):])
+
+        else:
+            args.append(rawFilename)
+
+    if daemonPath is not None:
+        serveDaemon(daemonPath, workers, maxRequests)
+    elif indexPath is not None:
+        index = MessageIndex(indexPath, indexBody)
+        try:
+            for directory in args:
+                counts = index.update(directory)
+                print('{0}: {1[added]} added, {1[updated]} updated, {1[unchanged]} unchanged, {1[removed]} removed'.format(directory, counts))
+        finally:
+            index.close()
+    elif searchPath is not None:
+        index = MessageIndex(searchPath)
+        try:
+            for path in index.search(' '.join(args)):
+                print(path)
+        finally:
+            index.close()
+    else:
+        import functools
+        handler = functools.partial(extractFile, writeRaw = writeRaw, toJson = toJson,
+                                    useFileName = useFileName, msgFilter = msgFilter, expand = expand,
+                                    outputDir = outputDir, fingerprintStore = fingerprintStore,
+                                    memoryBudget = memoryBudget, spillThreshold = spillThreshold,
+                                    memoryReport = memoryReport)
+        paths = scan(args, recursive, manifests)
+        journal = None
+        if journalPath is not None:
+            journal = Journal(journalPath, resume)
+            paths = (x for x in paths if x not in journal)
+        counts = {'extracted': 0, 'filtered': 0, 'duplicates': 0, 'failed': 0}
+        try:
+            for filename, result, error in processQueue(paths, handler, workers, maxQueued):
+                if error is not None:
+                    # Failed files stay out of the journal so --resume retries them
+                    counts['failed'] += 1
+                    sys.stderr.write('{0}: {1}'.format(filename, error))
+                    continue
+                if result is None:
+                    counts['filtered'] += 1
+                elif isinstance(result, dict):
+                    counts['duplicates'] += 1
                 else:
-                    msg.save(toJson, useFileName)
-            except Exception as e:
-                msg.debug()
-                print("Error with file '" + filename + "': " +
-                        traceback.format_exc())
+                    counts['extracted'] += 1
+                if journal is not None:
+                    journal.record(filename, result)
+        finally:
+            if journal is not None:
+                journal.close()
+            sys.stderr.write('{0} files: {1[extracted]} extracted, {1[filtered]} filtered, {1[duplicates]} duplicates, '
+                             '{1[failed]} failed\n'.format(sum(counts.values()), counts))
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+startup:
+    Measures the cost of `python -c "import ExtractMsg"` by timing it
+    against a bare interpreter start. Run from anywhere with the
+    interpreter to measure:
+
+        python benchmarks/startup.py [runs]
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def timeCommand(code, runs):
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code], cwd = root)
+        times.append(time.time() - start)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+def countModules(code):
+    out = subprocess.check_output([sys.executable, '-c', code + '; import sys; print(len(sys.modules))'], cwd = root)
+    return int(out.strip())
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    # Warm the file system cache and any .pyc files first
+    timeCommand('import ExtractMsg', 2)
+
+    bareBest, bareMedian = timeCommand('pass', runs)
+    best, median = timeCommand('import ExtractMsg', runs)
+    print('interpreter only:   best {0:.1f} ms, median {1:.1f} ms, {2} modules'.format(
+        bareBest * 1000, bareMedian * 1000, countModules('pass')))
+    print('import ExtractMsg:  best {0:.1f} ms, median {1:.1f} ms, {2} modules'.format(
+        best * 1000, median * 1000, countModules('import ExtractMsg')))
+    print('import cost:        best {0:.1f} ms, median {1:.1f} ms'.format(
+        (best - bareBest) * 1000, (median - bareMedian) * 1000))
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ExtractMsg import decode_utf7
+
+
+class DecodeUtf7Test(unittest.TestCase):
+    def test_known_vectors(self):
+        vectors = [
+            (b'', u''),
+            (b'INBOX', u'INBOX'),
+            (b'&-', u'&'),
+            (b'Tom &- Jerry', u'Tom & Jerry'),
+            (b'&AOk-', u'é'),
+            (b'caf&AOk-', u'café'),
+            (b'&U,BTFw-', u'台北'),
+            (b'~peter/mail/&U,BTFw-/&ZeVnLIqe-', u'~peter/mail/台北/日本語'),
+        ]
+        for encoded, decoded in vectors:
+            self.assertEqual(decode_utf7(encoded), decoded)
+
+    def test_unterminated(self):
+        self.assertEqual(decode_utf7(b'&AOk'), u'é')
+        self.assertEqual(decode_utf7(b'x&U,BTFw'), u'x台北')
+        self.assertEqual(decode_utf7(b'x&'), u'x')
+
+    def test_text_is_returned_unchanged(self):
+        self.assertEqual(decode_utf7(u'café'), u'café')
+        self.assertIsNone(decode_utf7(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import io
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import olefile
+
+from ExtractMsg import iterStream
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'example-msg-files', 'unicode.msg')
+
+FREESECT = 0xFFFFFFFF
+ENDOFCHAIN = 0xFFFFFFFE
+FATSECT = 0xFFFFFFFD
+NOSTREAM = 0xFFFFFFFF
+MINI_SECTOR = 64
+MINI_CUTOFF = 4096
+
+
+def buildCompoundFile(version, streams):
+    """
+    Writes a minimal compound file of `version` 3 (512 byte sectors) or 4
+    (4096 byte sectors) holding `streams`, a list of (name, data) pairs in
+    the root storage. The sectors of big streams are interleaved so their
+    FAT chains are not contiguous.
+    """
+    sectorSize = 512 if version == 3 else 4096
+    sectors = []
+    fat = []
+
+    def allocate(data):
+        index = len(sectors)
+        sectors.append(data.ljust(sectorSize, b'\0'))
+        fat.append(ENDOFCHAIN)
+        return index
+
+    def chain(indexes):
+        for a, b in zip(indexes, indexes[1:]):
+            fat[a] = b
+        return indexes[0] if indexes else ENDOFCHAIN
+
+    # Small streams go to the mini stream, one mini FAT chain each
+    ministream = b''
+    minifat = []
+    starts = {}
+    for name, data in streams:
+        if len(data) < MINI_CUTOFF:
+            if not data:
+                starts[name] = ENDOFCHAIN
+                continue
+            first = len(ministream) // MINI_SECTOR
+            count = (len(data) + MINI_SECTOR - 1) // MINI_SECTOR
+            minifat.extend(range(first + 1, first + count))
+            minifat.append(ENDOFCHAIN)
+            ministream += data.ljust(count * MINI_SECTOR, b'\0')
+            starts[name] = first
+
+    # Big streams take turns, one sector at a time
+    big = [(name, data) for name, data in streams if len(data) >= MINI_CUTOFF]
+    owned = dict((name, []) for name, data in big)
+    offset = 0
+    while any(offset < len(data) for name, data in big):
+        for name, data in big:
+            if offset < len(data):
+                owned[name].append(allocate(data[offset:offset + sectorSize]))
+        offset += sectorSize
+    for name, data in big:
+        starts[name] = chain(owned[name])
+
+    ministreamStart = chain([allocate(ministream[x:x + sectorSize])
+                             for x in range(0, len(ministream), sectorSize)])
+    minifatData = b''.join(struct.pack('<I', x) for x in minifat)
+    minifatSectors = [allocate(minifatData[x:x + sectorSize]) for x in range(0, len(minifatData), sectorSize)]
+    minifatStart = chain(minifatSectors)
+
+    def entry(name, kind, child, right, start, size):
+        encoded = name.encode('utf-16-le') + b'\0\0'
+        return struct.pack('<64sHBBIII16sIQQIQ', encoded, len(encoded), kind, 1, NOSTREAM, right, child,
+                           b'\0' * 16, 0, 0, 0, start, size)
+
+    entries = [entry(u'Root Entry', 5, 1 if streams else NOSTREAM, NOSTREAM, ministreamStart, len(ministream))]
+    for i, (name, data) in enumerate(streams):
+        right = i + 2 if i + 1 < len(streams) else NOSTREAM
+        entries.append(entry(name, 2, NOSTREAM, right, starts[name], len(data)))
+    perSector = sectorSize // 128
+    while len(entries) % perSector:
+        entries.append(struct.pack('<64sHBBIII16sIQQIQ', b'', 0, 0, 0, NOSTREAM, NOSTREAM, NOSTREAM,
+                                   b'\0' * 16, 0, 0, 0, 0, 0))
+    directory = b''.join(entries)
+    directorySectors = [allocate(directory[x:x + sectorSize]) for x in range(0, len(directory), sectorSize)]
+    directoryStart = chain(directorySectors)
+
+    perFat = sectorSize // 4
+    fatCount = 1
+    while (len(sectors) + fatCount + perFat - 1) // perFat > fatCount:
+        fatCount += 1
+    fatSectors = list(range(len(sectors), len(sectors) + fatCount))
+    fat.extend([FATSECT] * fatCount)
+    fat.extend([FREESECT] * (fatCount * perFat - len(fat)))
+    fatData = b''.join(struct.pack('<I', x) for x in fat)
+    sectors.extend(fatData[x:x + sectorSize] for x in range(0, len(fatData), sectorSize))
+
+    difat = fatSectors + [FREESECT] * (109 - len(fatSectors))
+    header = struct.pack('<8s16sHHHHH6sIIIIIIIII', olefile.MAGIC, b'\0' * 16, 0x3E, version, 0xFFFE,
+                         9 if version == 3 else 12, 6, b'\0' * 6,
+                         0 if version == 3 else len(directorySectors), fatCount, directoryStart, 0,
+                         MINI_CUTOFF, minifatStart, len(minifatSectors), ENDOFCHAIN, 0)
+    header += b''.join(struct.pack('<I', x) for x in difat)
+    return header.ljust(sectorSize, b'\0') + b''.join(sectors)
+
+
+def pattern(size, seed):
+    return bytes(bytearray((x * 7 + seed) % 251 for x in range(size)))
+
+
+class IterStreamTest(unittest.TestCase):
+    def assertStreamsMatch(self, ole):
+        streams = ole.listdir()
+        self.assertTrue(streams)
+        for stream in streams:
+            expected = ole.openstream(stream).read()
+            for chunkSize in (1, 1000, 4096, 1024 * 1024):
+                chunks = list(iterStream(ole, stream, chunkSize))
+                self.assertEqual(b''.join(chunks), expected, '/'.join(stream))
+
+    def check(self, version):
+        sectorSize = 512 if version == 3 else 4096
+        sizes = [0, 1, 63, 64, 65, MINI_CUTOFF - 1, MINI_CUTOFF, MINI_CUTOFF + 1,
+                 2 * sectorSize - 1, 2 * sectorSize, 2 * sectorSize + 1,
+                 5 * sectorSize + 3, 70000, 300001]
+        streams = [(u's{0:02d}'.format(i), pattern(size, i)) for i, size in enumerate(sizes)]
+        ole = olefile.OleFileIO(io.BytesIO(buildCompoundFile(version, streams)))
+        try:
+            self.assertEqual(ole.sectorsize, sectorSize)
+            for name, data in streams:
+                self.assertEqual(ole.openstream(name).read(), data)
+            self.assertStreamsMatch(ole)
+        finally:
+            ole.close()
+
+    def test_version3(self):
+        self.check(3)
+
+    def test_version4(self):
+        self.check(4)
+
+    def test_sample(self):
+        ole = olefile.OleFileIO(SAMPLE)
+        try:
+            self.assertStreamsMatch(ole)
+        finally:
+            ole.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'ExtractMsg.py')
+SAMPLE = os.path.join(ROOT, 'example-msg-files', 'unicode.msg')
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.msg = os.path.join(self.tmp, 'a.msg')
+        shutil.copy(SAMPLE, self.msg)
+        self.journal = os.path.join(self.tmp, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_cli(self, *args):
+        process = subprocess.Popen([sys.executable, SCRIPT] + list(args), cwd = self.tmp,
+                                   stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        out, err = process.communicate()
+        return err.decode('utf8', 'replace')
+
+    def records(self):
+        with open(self.journal) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def journaled(self):
+        return [filename for filename, outputs in self.records()]
+
+    def test_failed_file_is_retried_on_resume(self):
+        # A regular file as output directory makes every save fail
+        blocker = os.path.join(self.tmp, 'blocker')
+        open(blocker, 'w').close()
+        err = self.run_cli('--journal=' + self.journal, '--output-dir=' + blocker, self.msg)
+        self.assertIn('0 extracted, 0 filtered, 0 duplicates, 1 failed', err)
+        self.assertEqual(self.journaled(), [])
+
+        out = os.path.join(self.tmp, 'out')
+        err = self.run_cli('--journal=' + self.journal, '--resume', '--output-dir=out', self.msg)
+        self.assertIn('1 extracted, 0 filtered, 0 duplicates, 0 failed', err)
+        self.assertEqual(self.journaled(), [os.path.abspath(self.msg)])
+        self.assertTrue(os.listdir(out))
+        outputs = self.records()[0][1]
+        self.assertTrue(outputs)
+        for output in outputs:
+            self.assertTrue(os.path.isabs(output))
+            self.assertTrue(os.path.exists(output))
+
+        err = self.run_cli('--journal=' + self.journal, '--resume', '--output-dir=' + out, self.msg)
+        self.assertIn('0 files', err)
+
+
+if __name__ == '__main__':
+    unittest.main()